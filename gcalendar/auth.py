@@ -43,7 +43,8 @@ def get_credentials(args):
 def auth(args):
     credentials = get_credentials(args)
     http = credentials.authorize(httplib2.Http())
-    return discovery.build('calendar', 'v3', http=http)
+    # the discovery document bundled with the client library is used, which avoids downloading it on every start
+    return discovery.build('calendar', 'v3', http=http, cache_discovery=False, static_discovery=True)
 
 
 def main():
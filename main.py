@@ -1,12 +1,19 @@
 import argparse
 import datetime
+import functools
+import hashlib
+import io
 import json
+import socket
 import time
-from typing import List
+from typing import Callable, Dict, List, Optional, Tuple
 
 import requests
 import requests.auth
-from httplib2 import Response
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
 from oauth2client import tools
 
 import gcalendar
@@ -15,13 +22,68 @@ from apikeys import GIST_API_KEY, GIST_FILE_ID
 from common.match import Match
 from livescore_in import LiveScoreDownloader
 
+# orjson is faster and returns bytes that can be sent directly, but it is optional
+try:
+    from orjson import dumps as json_dumps
+except ImportError:
+    from json import dumps as json_dumps
+
 today = datetime.datetime.now().strftime("%Y-%m-%d")
 
+MATCH_DEFAULT_DURATION = datetime.timedelta(minutes=project_settings.MATCH_DEFAULT_DURATION_MINUTES)
+MATCH_EXTEND = datetime.timedelta(minutes=project_settings.MATCH_EXTEND_MINUTES)
+
+CALENDAR_INACTIVE_AFTER = datetime.timedelta(days=1)
+CALENDAR_ARCHIVE_AFTER = datetime.timedelta(days=3)
+# The time of the last change of each calendar, kept between the updates. The entry for a calendar
+# is removed whenever its events are changed, all other changes to the calendars are done by this script
+LAST_UPDATED_CACHE: Dict[str, datetime.datetime] = {}
+
+# the URL templates are split around the calendar ID once, so they don't have to be formatted for every calendar
+CALENDAR_ICAL_URL_PREFIX, CALENDAR_ICAL_URL_SUFFIX = project_settings.CALENDAR_ICAL_BASE_URL.split("{0}")
+CALENDAR_EMBED_URL_PREFIX, CALENDAR_EMBED_URL_SUFFIX = project_settings.CALENDAR_EMBED_BASE_URL.split("{0}")
+CALENDAR_IFRAME_PREFIX, CALENDAR_IFRAME_SUFFIX = project_settings.CALENDAR_IFRAME_BASE.split("{0}")
+
+
+# The kernel default waits 2 hours before the first keepalive probe, so the idle time and the interval
+# between the probes are set below the time between updates. Not all platforms have the options
+KEEPALIVE_SOCKET_OPTIONS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+if hasattr(socket, "TCP_KEEPIDLE"):
+    KEEPALIVE_SOCKET_OPTIONS.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30))
+if hasattr(socket, "TCP_KEEPINTVL"):
+    KEEPALIVE_SOCKET_OPTIONS.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10))
+if hasattr(socket, "TCP_KEEPCNT"):
+    KEEPALIVE_SOCKET_OPTIONS.append((socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3))
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """
+    Enables TCP keepalive on the pooled connections, so that they are not dropped
+    while sleeping between the updates
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + KEEPALIVE_SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
 
-def create_event(service, calendar_id: str, match: Match):
+
+# shared between the updates so that the connection to GitHub is reused instead of doing a new TLS handshake every time
+SESSION = requests.Session()
+SESSION.mount("https://", KeepAliveAdapter(pool_connections=10, pool_maxsize=20))
+
+# responses that are worth retrying after waiting a while
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# Google also uses 403 when the rate limit has been exceeded, with one of these reasons in the error
+GOOGLE_RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded"}
+
+# hash of the last successfully uploaded calendar URLs (without the updated time) and the response for it
+_last_gist_hash: Optional[str] = None
+_last_gist_response: Optional[requests.Response] = None
+
+
+def create_event(service, calendar_id: str, match: Match, now: datetime.datetime):
     # create the default duration for the tennis match
-    match_time_end = match.time.start + datetime.timedelta(minutes=project_settings.MATCH_DEFAULT_DURATION_MINUTES)
-    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    match_time_end = match.time.start + MATCH_DEFAULT_DURATION
 
     # if the tennis match is still going on, but there is no existing event,
     # then the computed end time might already have passed
@@ -30,7 +92,7 @@ def create_event(service, calendar_id: str, match: Match):
     # This checks for that case and makes sure that
     # if the initial match end time is less than NOW but the match is still GOIGN ON, then the end time is extended
     if match.is_still_going() and match_time_end < now:
-        match_time_end = now + datetime.timedelta(minutes=project_settings.MATCH_EXTEND_MINUTES)
+        match_time_end = now + MATCH_EXTEND
 
     event = {
         "summary": match.name,
@@ -46,24 +108,21 @@ def create_event(service, calendar_id: str, match: Match):
         "anyoneCanAddSelf": "true",
         "colorId": match.color
     }
-    created_event = service.events().insert(calendarId=calendar_id, body=event).execute()
-    print("Created event.")
+    request = service.events().insert(calendarId=calendar_id, body=event)
+
+    def on_success(created_event):
+        print("Created event:", created_event["summary"])
+
+    return request, on_success
 
 
-def different_start_times(old, new):
-    # the -1 on the existing event returns the datetime string without the Z at the end
-    # the rfind on match_time_start returns the datetime string woithout the +00:00 a the end
-    # they remove the 2 ways to specify timezone in the standard ISO format
-    # the reason we can remove it is that both are guaranteed to be UTC
-    return old["start"]["dateTime"][:-1] != new[:new.rfind("+")]
+def different_start_times(old, new: datetime.datetime) -> bool:
+    # compare the parsed times, so that it does not matter how the timezone is written in the existing event
+    return from_google_date_to_datetime(old["start"]["dateTime"]) != new
 
 
-def different_end_times(old, new):
-    # the -1 on the existing event returns the datetime string without the Z at the end
-    # the rfind on match_time_start returns the datetime string woithout the +00:00 a the end
-    # they remove the 2 ways to specify timezone in the standard ISO format
-    # the reason we can remove it is that both are guaranteed to be UTC
-    return old["end"]["dateTime"][:-1] != new[:new.rfind("+")]
+def different_end_times(old, new: datetime.datetime) -> bool:
+    return from_google_date_to_datetime(old["end"]["dateTime"]) != new
 
 
 def different_colors(old, new):
@@ -85,73 +144,106 @@ def show_if_different(word: str, old: str, new: str, time=False) -> str:
         return ""
 
 
+def from_google_timezone(designator: str) -> datetime.timezone:
+    """
+    Parses the timezone at the end of a Google date, e.g. Z, +01:00 or -0500
+    :param designator: String containing only the timezone
+    :return: timezone with the offset
+    """
+    if designator == "Z":
+        return datetime.timezone.utc
+    offset = datetime.timedelta(hours=int(designator[1:3]), minutes=int(designator[-2:]))
+    return datetime.timezone(-offset if designator[0] == "-" else offset)
+
+
+# The dates returned by Google are always in the RFC3339 format, so they are parsed by slicing
+# at the fixed offsets, which is much faster than strptime.
+# The same dates are parsed on every update, the cache is bounded as the script runs indefinitely
+@functools.lru_cache(maxsize=4096)
 def from_google_date_to_datetime(google_date: str) -> datetime.datetime:
-    return datetime.datetime.strptime(google_date.replace("Z", "+0000"),
-                                      "%Y-%m-%dT%H:%M:%S%z")
+    return datetime.datetime(int(google_date[0:4]), int(google_date[5:7]), int(google_date[8:10]),
+                             int(google_date[11:13]), int(google_date[14:16]), int(google_date[17:19]),
+                             tzinfo=from_google_timezone(google_date[19:]))
 
 
+@functools.lru_cache(maxsize=4096)
 def from_google_date_to_datetime_ms(google_date: str) -> datetime.datetime:
     """
     Includes microseconds in the date format
     :param google_date: String containing the date
     :return: parsed datetime object
     """
-    return datetime.datetime.strptime(google_date.replace("Z", "+0000"),
-                                      "%Y-%m-%dT%H:%M:%S.%f%z")
-
-
-def update_event(service, calendar_id: str, match: Match, existing_event: {}):
-    match_time_start = match.time.start.isoformat()
+    # the fraction after the seconds can have any number of digits, e.g. .123 for milliseconds
+    fraction_end = 20
+    while fraction_end < len(google_date) and google_date[fraction_end].isdigit():
+        fraction_end += 1
+    microseconds = int(google_date[20:fraction_end][:6].ljust(6, "0"))
+
+    return datetime.datetime(int(google_date[0:4]), int(google_date[5:7]), int(google_date[8:10]),
+                             int(google_date[11:13]), int(google_date[14:16]), int(google_date[17:19]),
+                             microseconds, tzinfo=from_google_timezone(google_date[fraction_end:]))
+
+
+def update_event(service, calendar_id: str, match: Match, existing_event: {}, now: datetime.datetime):
+    # the match attributes are used multiple times, so they are looked up only once
+    start = match.time.start
+    color = match.color
+    status_from_color = match.status_from_color
     event_time_end = from_google_date_to_datetime(existing_event["end"]["dateTime"])
 
     # If the event's end is less than the default match duration, then the end will be fixed
     # this can happen if the match time is moved N minutes forward, the end time also needs to be adjusted
     # NOTE this will only adjust the end time FORWARD. If the match is moved backwards the end time will NOT be
     # changed. Adjusting the time when the match is moved backwards will cause an issue with the event end adjustment!
-    expected_duration = match.time.start + datetime.timedelta(minutes=project_settings.MATCH_DEFAULT_DURATION_MINUTES)
+    expected_duration = start + MATCH_DEFAULT_DURATION
     if event_time_end < expected_duration:
         print("\tAdjusting end time.")
         event_time_end = expected_duration
 
     # if the match is live, but the end of the event in the calendar has passed, extend the end of the event
     # this will show in the calendar that the match hasn't yet ended
-    now = datetime.datetime.now(tz=datetime.timezone.utc)
     if match.is_still_going() and event_time_end < now:
         # move the end forward
         print("\tExtending end as it is still going.")
-        event_time_end = now + datetime.timedelta(minutes=project_settings.MATCH_EXTEND_MINUTES)
+        event_time_end = now + MATCH_EXTEND
 
-    event_time_end = event_time_end.isoformat()
-
-    if different_start_times(existing_event, match_time_start) \
-            or different_end_times(existing_event, event_time_end) \
-            or different_colors(existing_event, match.color):
+    # the colors are compared first as it is the cheapest check.
+    # The ISO strings are only created if the event needs to be updated
+    if different_colors(existing_event, color) \
+            or different_start_times(existing_event, start) \
+            or different_end_times(existing_event, event_time_end):
 
         old_start = existing_event["start"]["dateTime"]
         old_end = existing_event["end"]["dateTime"]
         old_color = existing_event["colorId"]
 
-        existing_event["start"] = {"dateTime": match_time_start}
-        existing_event["end"] = {"dateTime": event_time_end}
-        existing_event["colorId"] = match.color
-        update_result = service.events().update(calendarId=calendar_id, eventId=existing_event["id"],
-                                                body=existing_event).execute()
-
-        # the end="" removes the new line at the end
-        print("\tUpdated event:\n",
-              show_if_different("start", old_start, update_result["start"]["dateTime"], time=True),
-              show_if_different("end", old_end, update_result["end"]["dateTime"], time=True),
-              show_if_different("status", str(match.status_from_color(old_color)),
-                                str(match.status_from_color(match.color))),
-              end="")
+        existing_event["start"] = {"dateTime": start.isoformat()}
+        existing_event["end"] = {"dateTime": event_time_end.isoformat()}
+        existing_event["colorId"] = color
+        request = service.events().update(calendarId=calendar_id, eventId=existing_event["id"],
+                                          body=existing_event)
+
+        def on_success(update_result):
+            # the end="" removes the new line at the end
+            print(f"Updated event {update_result['summary']}:\n",
+                  show_if_different("start", old_start, update_result["start"]["dateTime"], time=True),
+                  show_if_different("end", old_end, update_result["end"]["dateTime"], time=True),
+                  show_if_different("status", str(status_from_color(old_color)),
+                                    str(status_from_color(color))),
+                  end="")
+
+        return request, on_success
     else:
         print("\tNo change.")
+        return None
 
 
-def update_finished_event(service, calendar_id: str, match: Match, existing_event: {}):
+def update_finished_event(service, calendar_id: str, match: Match, existing_event: {}, now: datetime.datetime):
+    # the match attributes are used multiple times, so they are looked up only once
+    color = match.color
+    status_from_color = match.status_from_color
     event_time_start = from_google_date_to_datetime(existing_event["start"]["dateTime"])
     event_time_end = from_google_date_to_datetime(existing_event["end"]["dateTime"])
-    now = datetime.datetime.now(tz=datetime.timezone.utc)
 
     # if the event has finished, but it's end time is after NOW, then change it to now
     # but make sure the event has actually started first, to avoid a Google Calendar event error
@@ -162,28 +254,94 @@ def update_finished_event(service, calendar_id: str, match: Match, existing_even
         old_color = existing_event["colorId"]
 
         existing_event["end"] = {"dateTime": event_time_end}
-        existing_event["colorId"] = match.color
-        update_result = service.events().update(calendarId=calendar_id, eventId=existing_event["id"],
-                                                body=existing_event).execute()
-
-        # the end="" removes the new line at the end
-        print("\tUpdated finished event:\n",
-              show_if_different("end", old_end, update_result["end"]["dateTime"]),
-              show_if_different("status", str(match.status_from_color(old_color)),
-                                str(match.status_from_color(match.color))),
-              end="")
-    elif existing_event["colorId"] != match.color:
+        existing_event["colorId"] = color
+        request = service.events().update(calendarId=calendar_id, eventId=existing_event["id"],
+                                          body=existing_event)
+
+        def on_success(update_result):
+            # the end="" removes the new line at the end
+            print(f"Updated finished event {update_result['summary']}:\n",
+                  show_if_different("end", old_end, update_result["end"]["dateTime"]),
+                  show_if_different("status", str(status_from_color(old_color)),
+                                    str(status_from_color(color))),
+                  end="")
+
+        return request, on_success
+    elif existing_event["colorId"] != color:
         old_color = existing_event["colorId"]
 
-        existing_event["colorId"] = match.color
-        update_result = service.events().update(calendarId=calendar_id, eventId=existing_event["id"],
-                                                body=existing_event).execute()
-        print("\tUpdated finished event color:\n",
-              show_if_different("status", str(match.status_from_color(old_color)),
-                                str(match.status_from_color(match.color))),
-              end="")
+        existing_event["colorId"] = color
+        request = service.events().update(calendarId=calendar_id, eventId=existing_event["id"],
+                                          body=existing_event)
+
+        def on_success(update_result):
+            print(f"Updated finished event color {update_result['summary']}:\n",
+                  show_if_different("status", str(status_from_color(old_color)),
+                                    str(status_from_color(color))),
+                  end="")
+
+        return request, on_success
     else:
         print("\tFinished. No changes.")
+        return None
+
+
+def is_retryable_google_error(error: HttpError) -> bool:
+    """
+    Checks if the request failed because of the rate limit or a temporary server error.
+    Any other 403, e.g. when the access to a calendar has been revoked, is not retryable
+    :param error: The error returned by the Google API
+    :return: True if the request can be retried after waiting a while
+    """
+    if error.resp.status in RETRY_STATUS_CODES:
+        return True
+    if error.resp.status != 403:
+        return False
+
+    try:
+        details = json.loads(error.content.decode("utf-8"))["error"]
+        # the reason is in "errors" in the Calendar API, newer errors use "details" instead
+        reasons = {detail.get("reason") for detail in details.get("errors", []) + details.get("details", [])
+                   if isinstance(detail, dict)}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return False
+    return not reasons.isdisjoint(GOOGLE_RATE_LIMIT_REASONS)
+
+
+def execute_batched(service, pending_requests: List[Tuple[str, HttpRequest, Callable[[dict], None]]]):
+    """
+    Sends the requests to Google in batches, instead of making a separate HTTP call for every request.
+    All requests are sent even if some of them fail, afterwards one of the errors is raised.
+    :param service: The Google Calendar API service
+    :param pending_requests: Tuples of (name used in messages, request, callback called with the response on success)
+    :raises HttpError: If any of the requests failed
+    """
+    errors = []
+
+    def make_callback(name, on_success):
+        def callback(request_id, response, exception):
+            if exception is not None:
+                print(f"Request for {name} failed: {exception}")
+                errors.append(exception)
+            else:
+                on_success(response)
+
+        return callback
+
+    # Google rejects batches with more than 50 requests, so they are split in chunks
+    chunk_size = project_settings.GOOGLE_BATCH_MAX_REQUESTS
+    for start in range(0, len(pending_requests), chunk_size):
+        batch = service.new_batch_http_request()
+        # the names don't have to be unique, e.g. two matches can have the same players,
+        # so the position of the request is used as the ID in the batch
+        for index, (name, request, on_success) in enumerate(pending_requests[start:start + chunk_size], start):
+            batch.add(request, callback=make_callback(name, on_success), request_id=str(index))
+        batch.execute()
+
+    if errors:
+        # a rate limit is raised in preference to other errors, so that the updates are backed off
+        raise next((error for error in errors
+                    if isinstance(error, HttpError) and is_retryable_google_error(error)), errors[0])
 
 
 def update_calendar_events(service, calendar_id, matches: List[Match]):
@@ -197,27 +355,43 @@ def update_calendar_events(service, calendar_id, matches: List[Match]):
     # WARNING this also means that if this code is executed for past days, then the events WILL NEVER BE UPDATED
     # as they are never queried and duplicates will be created instead of updating the time!
     events_result = service.events().list(calendarId=calendar_id, maxResults=100, timeMin=midnight).execute()
-    events = events_result.get('items', None)
+    events = events_result.get('items', None) or []
     print("Retrieved events for calendar.")
 
-    # TODO batch request https://developers.google.com/google-apps/calendar/batch
-    for match in matches:
-        match_event = [event for event in events if event["summary"] == match.name]
-        if len(match_event) > 1:
+    events_by_name = {}
+    for event in events:
+        if event["summary"] in events_by_name:
             raise ValueError("There is more than one event with matching names, and there should only be one!")
+        events_by_name[event["summary"]] = event
+
+    # all matches are compared against the same time
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+
+    # all creates/updates for the calendar are collected and sent together in batch requests
+    # https://developers.google.com/google-apps/calendar/batch
+    pending_requests = []
+    for match in matches:
+        match_event = events_by_name.get(match.name)
 
         print("Match: ", match.name)
 
         # if no events are found for that match then a new one is created
-        if len(match_event) == 0:
-            create_event(service, calendar_id, match)
+        if match_event is None:
+            pending = create_event(service, calendar_id, match, now)
         else:
-            match_event = match_event[0]
-
             if match.is_finished():
-                update_finished_event(service, calendar_id, match, match_event)
+                pending = update_finished_event(service, calendar_id, match, match_event, now)
             else:
-                update_event(service, calendar_id, match, match_event)
+                pending = update_event(service, calendar_id, match, match_event, now)
+
+        if pending is not None:
+            request, on_success = pending
+            pending_requests.append((match.name, request, on_success))
+
+    if pending_requests:
+        # the calendar will have a new last update time
+        LAST_UPDATED_CACHE.pop(calendar_id, None)
+    execute_batched(service, pending_requests)
 
 
 def create_calendar(service, tournament_name):
@@ -238,21 +412,8 @@ def create_calendar(service, tournament_name):
     return created_calendar["id"]
 
 
-def append_calendar_to_list(list_object: List[str], calendar_summary: str, calendar_id: str):
-    list_object.append(f"""### {calendar_summary}
-* ICAL: {project_settings.CALENDAR_ICAL_BASE_URL.format(calendar_id)}
-* Embed: {project_settings.CALENDAR_EMBED_BASE_URL.format(calendar_id)}
-* IFRAME: {project_settings.CALENDAR_IFRAME_BASE.format(calendar_id)}
-<hr/>
-""")
-
-
-def generate_calendar_urls(service) -> Response:
-    calendars_list_result = service.calendarList().list().execute()
-    calendars_list = calendars_list_result.get('items', None)
-    file_data: List[str] = [
-        rf"""Updated (UTC) time: {datetime.datetime.utcnow().isoformat()+'Z'}
-
+# instructions written at the top of the calendar URLs file, after the time of the update
+CALENDAR_URLS_HEADER = r"""
 ### Importing a calendar:
 1. Copy ICAL link from below.
 1. Add calendar by URL
@@ -290,65 +451,106 @@ def generate_calendar_urls(service) -> Response:
 
 <hr/>
 """
-    ]
+
+
+def append_calendar_to_list(section: io.StringIO, calendar_summary: str, calendar_id: str):
+    # separate the calendar from the previous one in the section
+    if section.tell() > 0:
+        section.write("\n")
+    section.write(f"""### {calendar_summary}
+* ICAL: {CALENDAR_ICAL_URL_PREFIX}{calendar_id}{CALENDAR_ICAL_URL_SUFFIX}
+* Embed: {CALENDAR_EMBED_URL_PREFIX}{calendar_id}{CALENDAR_EMBED_URL_SUFFIX}
+* IFRAME: {CALENDAR_IFRAME_PREFIX}{calendar_id}{CALENDAR_IFRAME_SUFFIX}
+<hr/>
+""")
+
+
+def generate_calendar_urls(service, calendars_list: List[dict]) -> requests.Response:
+    file_data = io.StringIO()
+    file_data.write(f"Updated (UTC) time: {datetime.datetime.utcnow().isoformat()}Z\n")
+    file_data.write(CALENDAR_URLS_HEADER)
 
     # matches that are live
-    active: List[str] = []
+    active = io.StringIO()
     # matches that have not had a match in the last day
-    inactive: List[str] = []
+    inactive = io.StringIO()
     # matches that have not had a match in the last 3 days
-    archive: List[str] = []
-    for calendar in calendars_list:
-        # remove primary calendar, and #contacts and #holidays
-        if "@gmail" not in calendar["id"] and "#" not in calendar["id"]:
-            #             file_data.append(f"""### {calendar["summary"]}
-            # * ICAL: {project_settings.CALENDAR_ICAL_BASE_URL.format(calendar["id"])}
-            # * Embed: {project_settings.CALENDAR_EMBED_BASE_URL.format(calendar["id"])}
-            # * IFRAME: {project_settings.CALENDAR_IFRAME_BASE.format(calendar["id"])}
-            # <hr/>
-            # """)
-            latest_event = service.events().list(calendarId=calendar["id"], maxResults=1).execute()
-            t1 = from_google_date_to_datetime_ms(latest_event["updated"])
-            time_elapsed = datetime.datetime.now(tz=datetime.timezone.utc) - t1
-            if time_elapsed > datetime.timedelta(days=3):
-                append_calendar_to_list(archive, calendar["summary"], calendar["id"])
-            elif time_elapsed > datetime.timedelta(days=1):
-                append_calendar_to_list(inactive, calendar["summary"], calendar["id"])
-            else:
-                append_calendar_to_list(active, calendar["summary"], calendar["id"])
+    archive = io.StringIO()
+    # remove primary calendar, and #contacts and #holidays
+    listed_calendars = [calendar for calendar in calendars_list
+                        if "@gmail" not in calendar["id"] and "#" not in calendar["id"]]
 
-    file_data.append("# Active")
-    file_data.append("\n".join(active))
-    file_data.append("# Inactive")
-    file_data.append("\n".join(inactive))
-    file_data.append("# Archive")
-    file_data.append("\n".join(archive))
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
 
-    file_data: str = "\n".join(file_data)
+    # the time of the last change of every calendar is read from the events list.
+    # All calendars are requested in batches, instead of sending a separate request for each one
+    pending_requests = []
+    for calendar in listed_calendars:
+        # archived calendars stay archived until their events are changed, which removes them from the cache
+        cached = LAST_UPDATED_CACHE.get(calendar["id"])
+        if cached is not None and now - cached > CALENDAR_ARCHIVE_AFTER:
+            continue
+
+        def on_success(latest_event, calendar_id=calendar["id"]):
+            LAST_UPDATED_CACHE[calendar_id] = from_google_date_to_datetime_ms(latest_event["updated"])
+
+        pending_requests.append(
+            (calendar["id"], service.events().list(calendarId=calendar["id"], maxResults=1), on_success))
+    # if any lookup fails the error is raised here, so that a file with missing calendars is never uploaded
+    execute_batched(service, pending_requests)
+
+    for calendar in listed_calendars:
+        time_elapsed = now - LAST_UPDATED_CACHE[calendar["id"]]
+        if time_elapsed > CALENDAR_ARCHIVE_AFTER:
+            append_calendar_to_list(archive, calendar["summary"], calendar["id"])
+        elif time_elapsed > CALENDAR_INACTIVE_AFTER:
+            append_calendar_to_list(inactive, calendar["summary"], calendar["id"])
+        else:
+            append_calendar_to_list(active, calendar["summary"], calendar["id"])
+
+    for title, section in (("Active", active), ("Inactive", inactive), ("Archive", archive)):
+        file_data.write(f"\n# {title}\n")
+        file_data.write(section.getvalue())
+        section.close()
+
+    # the buffers are released, so that only one copy of the file is kept while it is uploaded
+    content = file_data.getvalue()
+    file_data.close()
     with open(project_settings.CALENDAR_URLS_FILENAME, 'w') as f:
-        f.write(file_data)
+        f.write(content)
+
+    # the first line only contains the time of the update, so it is not used to check for changes
+    global _last_gist_hash, _last_gist_response
+    gist_hash = hashlib.sha256(content.partition("\n")[2].encode()).hexdigest()
+    if gist_hash == _last_gist_hash:
+        print("Calendar urls have not changed, skipping GIST upload.")
+        return _last_gist_response
 
     gist = {
         "description": "Tennis Calendars",
         "public": "true",
         "files": {
             project_settings.CALENDAR_URLS_FILENAME: {
-                "content": file_data
+                "content": content
             }
         }
 
     }
     print("Uploading calendar urls to GIST.")
-    gist_response = requests.patch(f'https://api.github.com/gists/{GIST_FILE_ID}',
-                                   auth=requests.auth.HTTPBasicAuth("DTasev", GIST_API_KEY),
-                                   data=json.dumps(gist))
+    gist_response = SESSION.patch(f'https://api.github.com/gists/{GIST_FILE_ID}',
+                                  auth=requests.auth.HTTPBasicAuth("DTasev", GIST_API_KEY),
+                                  data=json_dumps(gist),
+                                  headers={"Content-Type": "application/json"})
     print(gist_response)
+    if gist_response.status_code == 200:
+        _last_gist_hash = gist_hash
+        _last_gist_response = gist_response
     return gist_response
 
 
-def update_calendars(service, downloader) -> Response:
+def update_calendars(service, downloader) -> requests.Response:
     calendars_list_result = service.calendarList().list().execute()
-    calendars_list = calendars_list_result.get('items', None)
+    calendars_list = calendars_list_result.get('items', None) or []
     calendars = {}
     print("Calendars downloaded.")
 
@@ -368,6 +570,8 @@ def update_calendars(service, downloader) -> Response:
         if tournament_name not in calendars:
             print("Calendar not found, creating a new one...")
             calendar_id = create_calendar(service, tournament_name)
+            # add the new calendar so that it is included in the calendar URLs
+            calendars_list.append({"id": calendar_id, "summary": tournament_name})
         else:
             print("Calendar already exists.")
             calendar_id = calendars[tournament_name]["id"]
@@ -381,22 +585,54 @@ def update_calendars(service, downloader) -> Response:
             id += 1
 
     print("Generating calendar URLs.")
-    # pass in the service so that all calendars can be retrieved again.
-    # This will include any newly created calendars here
-    return generate_calendar_urls(service)
+    # the calendars list also contains any calendars that were created above
+    return generate_calendar_urls(service, calendars_list)
+
+
+def retry_after_seconds(retry_after: Optional[str], default: int) -> int:
+    """
+    Reads the time to wait from a Retry-After header
+    :param retry_after: Value of the header, if the response had one
+    :param default: Time to use if the header is missing or given as a date
+    :return: Number of seconds to wait before retrying
+    """
+    try:
+        return max(0, int(retry_after))
+    except (TypeError, ValueError):
+        return default
 
 
 def main(args):
     service = gcalendar.auth(args)
     downloader = LiveScoreDownloader()
 
+    # seconds added to the wait before the next update after a failure, doubles with every consecutive failure
+    backoff = project_settings.UPDATE_INTERVAL_SECONDS
     try:
         while True:
-            response = update_calendars(service, downloader)
+            # the updates run at a fixed interval, no matter how long each update takes
+            deadline = time.monotonic() + project_settings.UPDATE_INTERVAL_SECONDS
+            try:
+                response = update_calendars(service, downloader)
+                status, retry_after = response.status_code, response.headers.get("Retry-After")
+                retryable = status in RETRY_STATUS_CODES
+            except HttpError as e:
+                if not is_retryable_google_error(e):
+                    raise
+                response, status, retry_after = e, e.resp.status, e.resp.get("retry-after")
+                retryable = True
 
             # TODO count failure and on Nth failure send me an email
-            if response.status_code != 200:
+            if status == 200:
+                backoff = project_settings.UPDATE_INTERVAL_SECONDS
+            else:
                 print(f"Expected 200 OK, but got {response}")
+                if retryable:
+                    wait = retry_after_seconds(retry_after, backoff)
+                    print(f"Backing off for {wait} seconds.")
+                    # the wait is added on top of the normal interval, so every failure delays the next update
+                    deadline += wait
+                    backoff = min(backoff * 2, project_settings.MAX_BACKOFF_SECONDS)
 
             # TODO need a way to purge tournaments with matches older than a week? or longer?
             # or move into a past section in the online MD page
@@ -404,7 +640,7 @@ def main(args):
             # TODO make a webpage where u can click + and subscribe to tournament and get emails or phone notifications
             # this should be doable by using Chrome's notification feature (need to check API)
 
-            time.sleep(60)
+            time.sleep(max(0, deadline - time.monotonic()))
     except KeyboardInterrupt:
         downloader.quit()
 
@@ -32,3 +32,8 @@ else:
 LIVESCORE_URL = "http://www.livescore.in/free/444741/"
 MATCH_EXTEND_MINUTES = 30
 MATCH_DEFAULT_DURATION_MINUTES = 90
+UPDATE_INTERVAL_SECONDS = 60
+MAX_BACKOFF_SECONDS = 600
+
+# Google rejects batch requests that contain more than 50 calls
+GOOGLE_BATCH_MAX_REQUESTS = 50